@@ -1,16 +1,33 @@
 # ===== 1A START =====
 import asyncio  # 1A: асинхронный запуск
+import importlib.util  # 1A: проверка, установлен ли модуль
+import io  # 1A: файл в памяти (BytesIO)
 import logging  # 1A: логирование
+import multiprocessing  # 1A: способ запуска процессов-воркеров (spawn)
 import os  # 1A: переменные окружения
+import re  # 1A: регулярные выражения
 import tempfile  # 1A: временные папки/файлы
-from datetime import datetime  # 1A: НУЖНО для parse_timestamp/row_to_payload
+import threading  # 1A: блокировка (ленивое создание пула из разных потоков)
+import time  # 1A: замеры интервалов (прогресс загрузки)
+from concurrent.futures import ProcessPoolExecutor  # 1A: пул процессов (разбор Excel на всех ядрах)
+from concurrent.futures.process import BrokenProcessPool  # 1A: пул процессов сломан (воркер убит)
+from collections import OrderedDict  # 1A: словарь с порядком (LRU уже загруженных файлов)
+from datetime import datetime, timezone  # 1A: НУЖНО для payload_value/timestamp_column
+from functools import lru_cache  # 1A: кэш результатов функций
 from pathlib import Path  # 1A: работа с путями
-from typing import Any, Dict, List, Optional, Tuple  # 1A: типы
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Tuple  # 1A: типы
 
+import numpy as np  # 1A: массивы (идёт вместе с pandas)
+import orjson  # 1A: быстрый JSON (для jsonb)
 import pandas as pd  # 1A: чтение Excel
+import pyarrow as pa  # 1A: Arrow-таблицы (Parquet-копия с метаданными)
+import pyarrow.parquet as pq  # 1A: запись/чтение Parquet
 import psycopg  # 1A: PostgreSQL
-from psycopg.types.json import Jsonb  # 1A: упаковка dict → jsonb для Postgres
-from aiogram import Bot, Dispatcher, F  # 1A: aiogram
+from psycopg.types.json import Jsonb, set_json_dumps  # 1A: упаковка dict → jsonb для Postgres
+from psycopg_pool import ConnectionPool  # 1A: пул соединений с Postgres
+from openpyxl import load_workbook  # 1A: быстрое чтение строки заголовков .xlsx (read_only)
+from aiogram import Bot, Dispatcher, F, Router  # 1A: aiogram
+from aiogram.filters import Command, CommandObject, CommandStart  # 1A: фильтры команд
 from aiogram.types import Message  # 1A: тип сообщений
 from dotenv import load_dotenv  # 1A: .env
 # ===== 1A END =====
@@ -23,13 +40,36 @@ load_dotenv()  # 1B: грузим .env (локально полезно, в Rail
 
 # ===== 1C START =====
 BOT_TOKEN: Optional[str] = os.getenv("BOT_TOKEN")  # 1C: токен Telegram-бота
+BOT_DEBUG: bool = os.getenv("BOT_DEBUG") == "1"  # 1C: BOT_DEBUG=1 включает debug-ответ на всё непойманное (6A)
+log: logging.Logger = logging.getLogger("turnover_bot")  # 1C: логгер самого бота (уровень задаётся в 6B)
 DATABASE_URL: Optional[str] = os.getenv("DATABASE_URL")  # 1C: строка подключения к Postgres (Railway)
 
 TABLE_NAME: str = "public.raw_turnover_stock"  # 1C: целевая таблица в БД (сырой слой)
 
-# 1C: синонимы значений да/нет (часто встречаются в отчётах)
-TRUE_WORDS = {"1", "true", "True", "TRUE", "да", "Да", "ДА", "yes", "Yes", "Y", "y"}
-FALSE_WORDS = {"0", "false", "False", "FALSE", "нет", "Нет", "НЕТ", "no", "No", "N", "n"}
+META_TABLE: str = "public.bot_meta"  # 1C: служебная таблица бота (ключ -> значение)
+SCHEMA_META_KEY: str = "raw_turnover_stock_schema"  # 1C: ключ версии схемы в META_TABLE
+SCHEMA_VERSION: str = "1"  # 1C: поднять при изменении миграций в 3B — они выполнятся ещё раз
+
+# 1C: синонимы значений да/нет (часто встречаются в отчётах) -> True/False.
+#     Ключи в нижнем регистре: значение перед поиском приводим через casefold().
+#     "1.0"/"0.0" — так флаг выглядит, если Excel сохранил его числом.
+BOOL_WORDS: Dict[str, bool] = {
+    **dict.fromkeys(("1", "true", "да", "yes", "y", "1.0"), True),
+    **dict.fromkeys(("0", "false", "нет", "no", "n", "0.0"), False),
+}
+
+# 1C: известные форматы Period в строковом виде (день всегда первым).
+#     С явным format pandas не угадывает формат и не путает день с месяцем.
+PERIOD_FORMATS: Tuple[str, ...] = (
+    "%d.%m.%Y",
+    "%d.%m.%Y %H:%M:%S",
+    "%d-%m-%Y",
+    "%d-%m-%Y %H:%M:%S",
+    "%d/%m/%Y",
+    "%d/%m/%Y %H:%M:%S",
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+)
 
 # 1C: КОНТРАКТ колонок.
 #     Ключ = название колонки в Excel-отчёте (кириллица, как в файле).
@@ -70,6 +110,36 @@ RUS_TO_DB: Dict[str, str] = {
 # 1C: набор обязательных колонок после переименования (контроль контракта в коде)
 REQUIRED_DB_COLS = set(RUS_TO_DB.values())
 
+# 1C: движок чтения Excel: calamine (Rust, в разы быстрее), если пакет установлен, иначе openpyxl
+EXCEL_ENGINE: str = "calamine" if importlib.util.find_spec("python_calamine") else "openpyxl"
+
+# 1C: сколько процессов разбирают Excel параллельно (каждый держит свой pandas в памяти)
+#     По умолчанию 1: каждый воркер заново импортирует main.py (pandas, aiogram, psycopg)
+#     и держит ~150–200 МБ; отчёт приходит раз в неделю, а контейнер Railway маленький.
+#     Больше ядер и памяти -> поднять через EXCEL_WORKERS.
+EXCEL_WORKERS: int = int(os.getenv("EXCEL_WORKERS") or 1)
+
+# 1C: как часто (сек.) писать в чат прогресс загрузки большого файла
+PROGRESS_EVERY_S: float = 10.0
+
+# 1C: debug-ответ (6A) в один чат — не чаще раза в столько секунд, остальное только в лог
+DEBUG_ECHO_EVERY_S: float = 60.0
+
+# 1C: папка для Parquet-копий загруженных отчётов (для /reprocess без повторного чтения Excel)
+CACHE_DIR: Path = Path(os.getenv("CACHE_DIR") or Path(tempfile.gettempdir()) / "turnover_cache")
+
+# 1C: какие MIME-типы принимаем как .xlsx (некоторые клиенты шлют octet-stream)
+XLSX_MIME_TYPES: Tuple[str, ...] = (
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/octet-stream",
+)
+
+# 1C: максимальный размер файла — больше 20 МБ Bot API всё равно не даёт скачать
+MAX_UPLOAD_BYTES: int = 20 * 1024 * 1024
+
+# 1C: сколько последних загруженных файлов помнить (повторная отправка того же файла не грузится заново)
+SEEN_UPLOADS_MAX: int = 1000
+
 # ===== 1C END =====
 
 
@@ -101,99 +171,27 @@ def normalize_excel_header(name: Any) -> str:
     return s
 
 
+# 2A: таблица замены частых разделителей на "_" (один проход str.translate)
+_SNAKE_TRANS = str.maketrans({ch: "_" for ch in [" ", ".", "-", "/", "\\", "(", ")", "%", "№", ","]})
+
+# 2A: подряд идущие "_" -> один "_"
+_MULTI_UNDERSCORE = re.compile(r"_+")
+
+
+@lru_cache(maxsize=1024)
 def to_snake_case(name: str) -> str:
     """
     2A: Нормализуем имя поля под payload:
         - пробелы/точки/дефисы -> _
         - убираем двойные __
         - lower()
+        Имён колонок немного, поэтому результат кэшируем.
     """
     if name is None:
         return ""
-    s = str(name).strip()
+    s = str(name).strip().translate(_SNAKE_TRANS)
 
-    # заменяем частые разделители на "_"
-    for ch in [" ", ".", "-", "/", "\\", "(", ")", "%", "№", ","]:
-        s = s.replace(ch, "_")
-
-    # убираем подряд идущие "_"
-    while "__" in s:
-        s = s.replace("__", "_")
-
-    return s.strip("_").lower()
-
-
-def parse_bool(v: Any) -> Optional[bool]:
-    """
-    2A: Парсим флаговые значения.
-        Поддержка: 1/0, да/нет, true/false, yes/no, Y/N и т.п.
-        Пусто/NaN -> None
-    """
-    if v is None:
-        return None
-    try:
-        if pd.isna(v):
-            return None
-    except Exception:
-        pass
-
-    s = str(v).strip()
-    if s == "":
-        return None
-
-    if s in TRUE_WORDS:
-        return True
-    if s in FALSE_WORDS:
-        return False
-
-    # на всякий случай: "1.0"/"0.0"
-    if s == "1.0":
-        return True
-    if s == "0.0":
-        return False
-
-    return None
-
-
-def parse_numeric(v: Any) -> Optional[float]:
-    """
-    2A: Парсер чисел (NaN-safe).
-        ВАЖНО: NaN/пусто -> None (тогда в БД будет NULL, а sum() будет работать).
-        Поддержка строк: "1 234,56", "1234,56", "1 234,56" (неразрывный пробел),
-        а также варианты с точкой.
-    """
-    if v is None:
-        return None
-
-    # pandas/numpy NaN
-    try:
-        if pd.isna(v):
-            return None
-    except Exception:
-        pass
-
-    # уже число
-    if isinstance(v, (int, float)):
-        # float('nan') тоже отловим
-        if isinstance(v, float) and (v != v):
-            return None
-        return float(v)
-
-    s = str(v).strip()
-    if s == "":
-        return None
-
-    # удаляем пробелы/неразрывные пробелы, меняем запятую на точку
-    s = s.replace("\u00A0", "").replace("\u202F", "").replace(" ", "")
-    s = s.replace(",", ".")
-
-    try:
-        num = float(s)
-        if num != num:  # NaN
-            return None
-        return num
-    except Exception:
-        return None
+    return _MULTI_UNDERSCORE.sub("_", s).strip("_").lower()
 
 
 def parse_timestamp(v: Any) -> Optional["datetime"]:
@@ -206,8 +204,8 @@ def parse_timestamp(v: Any) -> Optional["datetime"]:
         - строки с временем
 
         ВАЖНО:
-        Для строк сначала пробуем dayfirst=True,
-        чтобы '03-08-2026' читалось как 08.03.2026, а не 03.08.2026.
+        Для строк сначала пробуем известные форматы PERIOD_FORMATS (день первым),
+        потом dayfirst=True, чтобы '03-08-2026' читалось как 08.03.2026, а не 03.08.2026.
     """
     if v is None:
         return None
@@ -232,127 +230,395 @@ def parse_timestamp(v: Any) -> Optional["datetime"]:
     if s == "":
         return None
 
-    # сначала пробуем "день-месяц-год"
-    try:
-        ts = pd.to_datetime(s, errors="coerce", dayfirst=True)
+    # сначала известные форматы (errors="coerce" не бросает исключений -> try не нужен)
+    for fmt in PERIOD_FORMATS:
+        ts = pd.to_datetime(s, format=fmt, errors="coerce")
         if not pd.isna(ts):
             return ts.to_pydatetime()
-    except Exception:
-        pass
+
+    # потом "день-месяц-год" с угадыванием формата
+    ts = pd.to_datetime(s, errors="coerce", dayfirst=True)
+    if not pd.isna(ts):
+        return ts.to_pydatetime()
 
     # если не вышло - запасной вариант
-    try:
-        ts = pd.to_datetime(s, errors="coerce", dayfirst=False)
-        if not pd.isna(ts):
-            return ts.to_pydatetime()
-    except Exception:
-        pass
+    ts = pd.to_datetime(s, errors="coerce", dayfirst=False)
+    if not pd.isna(ts):
+        return ts.to_pydatetime()
 
     return None
 # ===== 2A END =====
 
 
 # ===== 2B START =====
-def row_to_payload(row: Any) -> Dict[str, Any]:
+def payload_value(v: Any) -> Any:
     """
-    2B: Собираем payload для jsonb.
-
-    Правило:
-    - В момент вызова row_to_payload() row уже должен содержать колонки с DB-именами
-      (после df.rename(columns=RUS_TO_DB)).
-    - payload хранит "сырьё строки" в удобном виде:
-        * ключи = snake_case от DB-имени
-        * значения = нормализованные Python-типы (None вместо NaN)
+    2B: Одно значение -> JSON-дружелюбный Python-тип для payload.
+        NaN/NaT -> None, datetime -> ISO строка, строки без пробелов по краям ("" -> None).
     """
+    # 2B: NaN/NaT -> None
+    try:
+        if pd.isna(v):
+            return None
+    except Exception:
+        pass
 
-    # 2B: приводим вход к dict
-    if isinstance(row, pd.Series):
-        data = row.to_dict()
-    elif isinstance(row, dict):
-        data = row
-    else:
-        # на крайний случай
+    # 2B: datetime / Timestamp -> ISO строка (чтобы json был чистый)
+    if isinstance(v, (pd.Timestamp, datetime)):
         try:
-            data = dict(row)
+            return v.isoformat()
         except Exception:
-            return {}
+            return str(v)
+
+    # 2B: numpy типы / обычные числа
+    if isinstance(v, (int, float, bool)):
+        # float('nan') (на всякий случай)
+        if isinstance(v, float) and (v != v):
+            return None
+        return v
 
-    payload: Dict[str, Any] = {}
+    # 2B: строки
+    if isinstance(v, str):
+        s = v.strip()
+        return s if s != "" else None
 
-    for k, v in data.items():
-        # 2B: пропускаем пустые ключи
-        if k is None:
-            continue
+    # 2B: прочие типы (оставляем как есть, если сериализуется)
+    return v
 
-        key = to_snake_case(str(k))
 
-        # 2B: NaN/NaT -> None
-        try:
-            if pd.isna(v):
-                payload[key] = None
-                continue
-        except Exception:
-            pass
-
-        # 2B: datetime / Timestamp -> ISO строка (чтобы json был чистый)
-        if isinstance(v, (pd.Timestamp, datetime)):
-            try:
-                payload[key] = v.isoformat()
-            except Exception:
-                payload[key] = str(v)
-            continue
-
-        # 2B: numpy типы / обычные числа
-        if isinstance(v, (int, float, bool)):
-            # float('nan') (на всякий случай)
-            if isinstance(v, float) and (v != v):
-                payload[key] = None
-            else:
-                payload[key] = v
-            continue
+def _payload_column(col: pd.Series) -> pd.Series:
+    # 2B: те же правила, что в payload_value, но сразу для всей колонки
+    if pd.api.types.is_datetime64_any_dtype(col):
+        # 2B: isoformat, как в payload_value (с микросекундами и часовым поясом); NaT -> None
+        return col.map(payload_value)
+
+    if pd.api.types.is_numeric_dtype(col):
+        return col  # 2B: числа и bool как есть (NaN уберём ниже)
 
-        # 2B: строки
-        if isinstance(v, str):
-            s = v.strip()
-            payload[key] = s if s != "" else None
-            continue
+    if pd.api.types.infer_dtype(col, skipna=True) == "string":
+        s = col.str.strip()
+        return s.mask(s == "")  # 2B: "" -> пусто
 
-        # 2B: прочие типы (оставляем как есть, если сериализуется)
-        payload[key] = v
+    # 2B: смешанные колонки (даты вперемешку с текстом и т.п.) — по ячейкам
+    return col.map(payload_value)
+
+
+def frame_to_payloads(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """
+    2B: payload для всех строк DataFrame разом (колонки уже с DB-именами).
+        Колонки переименовываем в snake_case один раз,
+        значения готовим по колонкам, а словари строк собираем одним to_dict().
+    """
+    out = df.set_axis([to_snake_case(str(col)) for col in df.columns], axis=1)
+    out = pd.DataFrame({name: _payload_column(out.iloc[:, i]) for i, name in enumerate(out.columns)})
 
-    return payload
+    # 2B: NaN/NaT/NA -> None, числа -> обычные Python-типы
+    out = out.astype(object).where(out.notna(), None)
+    return out.to_dict(orient="records")
 # ===== 2B END =====
 
 
+# ===== 2C START =====
+def _none_for_missing(col: pd.Series) -> pd.Series:
+    # 2C: NaN/NaT/NA -> None, значения становятся обычными Python-объектами (для COPY)
+    return col.astype(object).where(col.notna(), None)
+
+
+def text_column(col: pd.Series) -> pd.Series:
+    """
+    2C: Колонка -> строки.
+        Пусто/NaN -> None
+    """
+    # 2C: astype(object) перед where: иначе pandas 3 вернёт str-колонку с NaN вместо None,
+    #     а бинарный COPY в text не принимает float
+    return col.astype(str).astype(object).where(col.notna(), None)
+
+
+def numeric_column(col: pd.Series) -> pd.Series:
+    """
+    2C: Колонка -> float.
+        Поддержка строк: "1 234,56", "1234,56", "1 234,56" (неразрывный пробел), варианты с точкой.
+        Числовые колонки просто приводим к float,
+        строки чистим от пробелов и запятой целиком по колонке.
+    """
+    if pd.api.types.is_numeric_dtype(col) and not pd.api.types.is_bool_dtype(col):
+        return _none_for_missing(pd.to_numeric(col, errors="coerce").astype("float64"))
+
+    s = col.astype(str)
+    s = s.str.replace("\u00A0", "", regex=False).str.replace("\u202F", "", regex=False)
+    s = s.str.replace(" ", "", regex=False).str.replace(",", ".", regex=False)
+
+    # 2C: "nan"/"None"/мусор -> NaN -> None
+    return _none_for_missing(pd.to_numeric(s, errors="coerce").astype("float64"))
+
+
+def bool_column(col: pd.Series) -> pd.Series:
+    """
+    2C: Колонка -> bool по словарю BOOL_WORDS (1/0, да/нет, true/false, yes/no, Y/N).
+        Неизвестные значения и пусто -> None
+    """
+    return _none_for_missing(col.astype(str).str.strip().str.casefold().map(BOOL_WORDS))
+
+
+def _naive_utc(ts: Optional[datetime]) -> Optional[datetime]:
+    # 2C: значение с часовым поясом ("...+03:00") -> тот же момент в UTC, без пояса.
+    #     period грузится через COPY как timestamp (без пояса, см. 3C): aware-значение там
+    #     роняет write_row, а смесь aware и naive — ещё и сортировку. Наивные значения
+    #     Postgres трактует в часовом поясе сессии (у Railway/Supabase это UTC) —
+    #     так aware-значение попадает в timestamptz тем же моментом, что и раньше
+    if ts is None or ts.tzinfo is None:
+        return ts
+    return ts.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def timestamp_column(col: pd.Series) -> pd.Series:
+    """
+    2C: Колонка -> datetime (векторный аналог parse_timestamp).
+        В отчёте Period одинаковый почти во всех строках,
+        поэтому разбираем только уникальные значения и раскладываем результат по кодам.
+    """
+    codes, uniques = pd.factorize(col)  # 2C: NaN получает код -1
+
+    # 2C: последний элемент None — на него и попадают коды -1
+    lookup = np.array([_naive_utc(parse_timestamp(u)) for u in uniques] + [None], dtype=object)
+    return pd.Series(lookup[codes], index=col.index, dtype=object)
+
+
+# 2C: какой разборщик применять к колонке по её типу в COPY_COLUMNS (блок 3C)
+COLUMN_PARSERS: Dict[str, Callable[[pd.Series], pd.Series]] = {
+    "timestamp": timestamp_column,
+    "text": text_column,
+    "bool": bool_column,
+    "float8": numeric_column,
+}
+# ===== 2C END =====
+
+
+# ===== 2D START =====
+def read_excel_header(path: Any) -> List[Any]:
+    """
+    2D: Только строка заголовков первого листа.
+        openpyxl в режиме read_only читает лист потоком и останавливается на первой строке —
+        это миллисекунды, а pd.read_excel(nrows=0) на calamine всё равно разбирает весь лист.
+    """
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        return list(next(wb.worksheets[0].iter_rows(max_row=1, values_only=True), ()))
+    finally:
+        wb.close()  # 2D: read_only держит файл открытым до close()
+
+
+def read_report_excel(path: Any) -> pd.DataFrame:
+    """
+    2D: Читаем Excel-отчёт целиком, одним проходом pandas.
+        - engine: EXCEL_ENGINE (calamine, если установлен; иначе openpyxl)
+        - все колонки: колонки вне контракта уходят в payload (3C), так новые поля отчёта
+          не теряются и не ломают загрузку
+        - dtype: текстовые колонки контракта сразу строками (без угадывания типа по ячейкам),
+          иначе код 12345 в колонке с пустой ячейкой стал бы float и строкой '12345.0'
+        Period здесь НЕ разбираем (parse_dates не умеет dayfirst):
+        он разбирается в upsert_dataframe через timestamp_column.
+    """
+    # 2D: заголовки берём отдельно (read_excel_header): dtype ключуется настоящими именами
+    #     колонок файла, а контракт сравниваем после нормализации (хвостовые/невидимые пробелы)
+    header = read_excel_header(path)
+    if hasattr(path, "seek"):
+        path.seek(0)  # 2D: после openpyxl BytesIO перематываем в начало для pandas
+
+    # 2D: текстовые DB-колонки берём из COPY_COLUMNS (блок 3C), чтобы не дублировать список
+    text_db_cols = {name for name, pg_type in COPY_COLUMNS if pg_type == "text"}
+    dtype = {
+        col: "string"
+        for col in header
+        if isinstance(col, str) and RUS_TO_DB.get(normalize_excel_header(col)) in text_db_cols
+    }
+
+    return pd.read_excel(path, engine=EXCEL_ENGINE, dtype=dtype)
+
+
+def read_report_excel_bytes(data: bytes) -> pd.DataFrame:
+    # 2D: то же, что read_report_excel, но из байтов — так файл передаётся в процесс-воркер
+    return read_report_excel(io.BytesIO(data))
+
+
+# 2D: пул процессов для разбора Excel: разбор упирается в CPU и GIL, и в потоке
+#     параллельные загрузки шли бы по очереди. spawn, а не fork: в основном процессе
+#     уже работают потоки (пул БД), форк такого процесса может зависнуть.
+#     Сами процессы запускаются при первой загрузке, не при импорте.
+def new_excel_executor() -> ProcessPoolExecutor:
+    # 2D: новый пул процессов для разбора Excel
+    return ProcessPoolExecutor(
+        max_workers=EXCEL_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+excel_executor = new_excel_executor()
+
+
+async def read_report_excel_in_pool(data: bytes) -> pd.DataFrame:
+    """
+    2D: Разбираем Excel в пуле процессов.
+        Если воркер умер (например, его убил OOM на большом файле), пул сломан навсегда:
+        заменяем его новым, чтобы следующие загрузки работали, и пробрасываем ошибку.
+    """
+    global excel_executor
+    pool = excel_executor
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, read_report_excel_bytes, data)
+    except BrokenProcessPool:
+        # 2D: пул могла уже заменить параллельная загрузка — тогда второй раз не меняем
+        if excel_executor is pool:
+            excel_executor = new_excel_executor()
+            pool.shutdown(wait=False, cancel_futures=True)
+            log.warning("Excel worker process died, process pool recreated")
+        raise
+
+
+def report_cache_path(filename: str) -> Path:
+    # 2D: путь к Parquet-копии отчёта (только имя файла — без чужих папок)
+    return CACHE_DIR / f"{Path(filename).name}.parquet"
+
+
+# 2D: ключ метаданных Parquet: какие колонки сохранены по ячейкам в JSON (см. save_report_cache)
+CACHE_JSON_COLUMNS_KEY: bytes = b"turnover_bot.json_columns"
+
+
+def _cache_cell_dumps(v: Any) -> Optional[bytes]:
+    # 2D: одна ячейка смешанной колонки -> JSON с сохранением типа.
+    #     datetime помечаем отдельно, иначе после чтения он стал бы просто строкой
+    if v is None or pd.isna(v):
+        return None
+    if isinstance(v, datetime):  # 2D: pd.Timestamp тоже datetime
+        return orjson.dumps({"dt": v.isoformat()})
+    return orjson.dumps(v, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def _cache_cell_loads(b: Optional[bytes]) -> Any:
+    # 2D: обратное к _cache_cell_dumps
+    if b is None:
+        return None
+    v = orjson.loads(b)
+    if isinstance(v, dict):
+        return datetime.fromisoformat(v["dt"])
+    return v
+
+
+def save_report_cache(df: pd.DataFrame, filename: str) -> Path:
+    """
+    2D: Сохраняем прочитанный отчёт в Parquet (колонки уже с DB-именами).
+        Parquet колоночный и в разы быстрее, чем заново разбирать .xlsx.
+        Object-колонки со смешанными типами (код 12345 числом и A1 строкой) Arrow не пишет,
+        а приведение к строке поменяло бы данные (3 -> '3', дата -> текст) и /reprocess
+        перезаписал бы payload другими значениями. Поэтому такие колонки пишем
+        по ячейкам в JSON с сохранением типа, а их список — в метаданные файла.
+    """
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = report_cache_path(filename)
+
+    out = rename_to_db(df)
+    json_cols = [
+        col
+        for col in out.select_dtypes(include="object").columns
+        if pd.api.types.infer_dtype(out[col], skipna=True) not in ("string", "empty")
+    ]
+    out = out.assign(**{col: out[col].map(_cache_cell_dumps) for col in json_cols})
+
+    try:
+        table = pa.Table.from_pandas(out, preserve_index=False)
+        metadata = {**(table.schema.metadata or {}), CACHE_JSON_COLUMNS_KEY: orjson.dumps(json_cols)}
+        pq.write_table(table.replace_schema_metadata(metadata), path, compression="zstd")
+    except Exception:
+        # 2D: не оставляем старую копию под этим именем — иначе /reprocess
+        #     молча загрузил бы данные предыдущего файла
+        path.unlink(missing_ok=True)
+        raise
+    return path
+
+
+def load_report_cache(filename: str) -> pd.DataFrame:
+    # 2D: читаем Parquet-копию целиком (колонки вне контракта нужны для payload)
+    #     и возвращаем смешанным колонкам исходные типы ячеек
+    table = pq.read_table(report_cache_path(filename))
+    json_cols = orjson.loads((table.schema.metadata or {}).get(CACHE_JSON_COLUMNS_KEY, b"[]"))
+    df = table.to_pandas()
+    return df.assign(**{col: df[col].map(_cache_cell_loads) for col in json_cols})
+# ===== 2D END =====
+
+
 # ===== 3A START =====
-def db_connect() -> psycopg.Connection:
-    # 3A: соединение с БД
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL is not set")
-    return psycopg.connect(DATABASE_URL)
+# 3A: jsonb (payload) сериализуем через orjson: в разы быстрее stdlib json, понимает numpy-типы
+set_json_dumps(lambda obj: orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY))
+
+_pool: Optional[ConnectionPool] = None  # 3A: пул соединений (создаётся при первом обращении)
+_pool_lock = threading.Lock()  # 3A: к БД обращаемся из рабочих потоков — создаём пул под замком
+
+
+def db_pool() -> ConnectionPool:
+    # 3A: один пул на процесс: TCP+TLS+auth платим один раз, дальше соединения переиспользуются
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if not DATABASE_URL:
+                raise RuntimeError("DATABASE_URL is not set")
+            _pool = ConnectionPool(DATABASE_URL, min_size=1, max_size=4, open=True)
+        return _pool
+
+
+def db_pool_close() -> None:
+    # 3A: закрываем пул при остановке бота (соединения корректно закрываются на стороне Postgres)
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def db_connect() -> ContextManager[psycopg.Connection]:
+    # 3A: соединение из пула; "with db_connect() as conn" возвращает его в пул на выходе
+    return db_pool().connection()
 
 
 def db_exec(sql: str) -> None:
-    # 3A: выполнить SQL без результата
+    # 3A: выполнить SQL без результата (без параметров можно несколько statements через ';')
     with db_connect() as conn:
         with conn.cursor() as cur:
             cur.execute(sql)
         conn.commit()
 
 
-def db_fetchone(sql: str) -> Any:
-    # 3A: выполнить SQL и вернуть одну строку
+def db_fetchone(sql: str, params: Optional[Tuple[Any, ...]] = None) -> Any:
+    # 3A: выполнить SQL и вернуть одну строку.
+    #     conn.execute сам создаёт курсор; prepare=False — разовый служебный запрос не готовим
     with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute(sql)
-            return cur.fetchone()
+        return conn.execute(sql, params, prepare=False).fetchone()
 # ===== 3A END =====
 
 
 # ===== 3B START =====
+_schema_ready: bool = False  # 3B: схема уже проверена этим процессом
+_schema_lock = threading.Lock()  # 3B: ensure_schema зовут из разных потоков (to_thread) — проверяем по одному
+
+
 def ensure_schema() -> None:
+    # 3B: проверяем схему один раз на процесс (повторные вызовы ничего не делают)
+    if _schema_ready:
+        return
+
+    with _schema_lock:
+        # 3B: пока ждали замок, схему мог проверить другой поток
+        if not _schema_ready:
+            _ensure_schema_locked()
+
+
+def _ensure_schema_locked() -> None:
+    # 3B: сама проверка/создание схемы (вызывается только под _schema_lock)
+    global _schema_ready
+
+    statements: List[str] = []  # 3B: весь DDL копим и отправляем одним запросом
+
     # 3B: создаём таблицу под наш фиксированный контракт колонок (если её нет)
-    db_exec(
+    statements.append(
         f"""
         create table if not exists {TABLE_NAME} (
             id bigserial primary key,
@@ -407,90 +673,264 @@ def ensure_schema() -> None:
             prof_pc numeric,
             prof_stock numeric,
 
-            -- 3B: сырьё целиком (на всякий случай)
+            -- 3B: колонки отчёта вне контракта (если есть), иначе NULL
             payload jsonb,
 
             -- 3B: уникальность строки в снимке (один товар в одном периоде)
             constraint ux_raw_turnover_stock unique (period, item_code)
-        );
+        )
         """
     )
 
+    # 3B: служебная таблица "ключ -> значение" (здесь храним версию схемы)
+    statements.append(f"create table if not exists {META_TABLE} (k text primary key, v text)")
+
     # 3B: "мягкие миграции" (если таблица когда-то уже создавалась неполной)
     #     Добавляем недостающие колонки без падения.
-    db_exec(f"alter table {TABLE_NAME} add column if not exists period timestamptz;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists loaded_ts timestamptz not null default now();")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists source_file text;")
+    #     Выполняются, только если версия схемы в META_TABLE отличается от SCHEMA_VERSION.
+    #     Все колонки — одним alter table: один разбор и одна блокировка таблицы вместо ~30.
+    migrations: List[str] = []
+    migrations.append(
+        f"""
+        alter table {TABLE_NAME}
+            add column if not exists period timestamptz,
+            add column if not exists loaded_ts timestamptz not null default now(),
+            add column if not exists source_file text,
 
-    db_exec(f"alter table {TABLE_NAME} add column if not exists item text;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists item_code text;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists article text;")
+            add column if not exists item text,
+            add column if not exists item_code text,
+            add column if not exists article text,
 
-    db_exec(f"alter table {TABLE_NAME} add column if not exists segment text;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists pg text;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists guz text;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists gau text;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists manager text;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists supplier text;")
+            add column if not exists segment text,
+            add column if not exists pg text,
+            add column if not exists guz text,
+            add column if not exists gau text,
+            add column if not exists manager text,
+            add column if not exists supplier text,
 
-    db_exec(f"alter table {TABLE_NAME} add column if not exists nonliq boolean;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists n_descn text;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists level_turns text;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists rank_turns text;")
+            add column if not exists nonliq boolean,
+            add column if not exists n_descn text,
+            add column if not exists level_turns text,
+            add column if not exists rank_turns text,
 
-    db_exec(f"alter table {TABLE_NAME} add column if not exists av_stock_qty numeric;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists sales_qty numeric;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists revenue numeric;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists curr_stock_qty numeric;")
+            add column if not exists av_stock_qty numeric,
+            add column if not exists sales_qty numeric,
+            add column if not exists revenue numeric,
+            add column if not exists curr_stock_qty numeric,
 
-    db_exec(f"alter table {TABLE_NAME} add column if not exists curr_stock_cost numeric;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists sales_cost numeric;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists av_stock_cost numeric;")
+            add column if not exists curr_stock_cost numeric,
+            add column if not exists sales_cost numeric,
+            add column if not exists av_stock_cost numeric,
 
-    db_exec(f"alter table {TABLE_NAME} add column if not exists turns_rub numeric;")
+            add column if not exists turns_rub numeric,
 
-    db_exec(f"alter table {TABLE_NAME} add column if not exists free_stock_q_ty numeric;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists free_stock_cost numeric;")
+            add column if not exists free_stock_q_ty numeric,
+            add column if not exists free_stock_cost numeric,
 
-    db_exec(f"alter table {TABLE_NAME} add column if not exists rezerv_qty numeric;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists rezerv_cost numeric;")
+            add column if not exists rezerv_qty numeric,
+            add column if not exists rezerv_cost numeric,
 
-    db_exec(f"alter table {TABLE_NAME} add column if not exists margin numeric;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists prof_pc numeric;")
-    db_exec(f"alter table {TABLE_NAME} add column if not exists prof_stock numeric;")
+            add column if not exists margin numeric,
+            add column if not exists prof_pc numeric,
+            add column if not exists prof_stock numeric,
 
-    db_exec(f"alter table {TABLE_NAME} add column if not exists payload jsonb;")
+            add column if not exists payload jsonb
+        """
+    )
 
     # 3B: уникальный constraint тоже "мягко" не добавляется через IF NOT EXISTS,
     #     поэтому создаём уникальный индекс, если его ещё нет (работает как constraint).
-    db_exec(
+    migrations.append(
         f"""
         create unique index if not exists ux_raw_turnover_stock_period_code
-        on {TABLE_NAME} (period, item_code);
+        on {TABLE_NAME} (period, item_code)
         """
     )
+
+    # 3B: одно соединение, одна транзакция
+    with db_connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute(";\n".join(statements))
+
+            # 3B: миграции уже применялись к этой версии схемы? тогда пропускаем
+            cur.execute(f"select v from {META_TABLE} where k = %s", (SCHEMA_META_KEY,))
+            row = cur.fetchone()
+            if row is None or row[0] != SCHEMA_VERSION:
+                cur.execute(";\n".join(migrations))
+                cur.execute(
+                    f"insert into {META_TABLE} (k, v) values (%s, %s) "
+                    "on conflict (k) do update set v = excluded.v",
+                    (SCHEMA_META_KEY, SCHEMA_VERSION),
+                )
+        conn.commit()
+
+    _schema_ready = True
 # ===== 3B END =====
 
 
 # ===== 3C START =====
-def _s(v: Any) -> Optional[str]:
-    # 3C: безопасно приводим значение к строке (None/NaN -> None)
-    if v is None or pd.isna(v):
-        return None
-    return str(v)
+STAGE_TABLE: str = "tmp_raw_turnover_stock"  # 3C: временная таблица для COPY (удаляется на commit)
+UPSERT_CHUNK_ROWS: int = 10_000  # 3C: размер пачки строк на один COPY + upsert
+
+# 3C: колонки загрузки в порядке значений в кортеже строки + тип для бинарного COPY.
+#     period грузим как timestamp (наивный datetime из Excel), метрики — как float8:
+#     так Python-значения пишутся в бинарном виде как есть, а при insert ... select
+#     Postgres сам приводит их к timestamptz/numeric основной таблицы.
+COPY_COLUMNS: List[Tuple[str, str]] = [
+    ("period", "timestamp"),
+
+    ("item", "text"),
+    ("item_code", "text"),
+    ("article", "text"),
+
+    ("segment", "text"),
+    ("pg", "text"),
+    ("guz", "text"),
+    ("gau", "text"),
+    ("manager", "text"),
+    ("supplier", "text"),
+
+    ("nonliq", "bool"),
+    ("n_descn", "text"),
+    ("level_turns", "text"),
+    ("rank_turns", "text"),
+
+    ("av_stock_qty", "float8"),
+    ("sales_qty", "float8"),
+    ("revenue", "float8"),
+    ("curr_stock_qty", "float8"),
+
+    ("curr_stock_cost", "float8"),
+    ("sales_cost", "float8"),
+    ("av_stock_cost", "float8"),
+
+    ("turns_rub", "float8"),
+
+    ("free_stock_q_ty", "float8"),
+    ("free_stock_cost", "float8"),
+
+    ("rezerv_qty", "float8"),
+    ("rezerv_cost", "float8"),
+
+    ("margin", "float8"),
+    ("prof_pc", "float8"),
+    ("prof_stock", "float8"),
+
+    ("payload", "jsonb"),
+]
+
+COPY_NAMES: List[str] = [name for name, _ in COPY_COLUMNS]  # 3C: только имена колонок
+COPY_TYPES: List[str] = [pg_type for _, pg_type in COPY_COLUMNS]  # 3C: только типы (для set_types)
+
+# 3C: DDL временной таблицы (on commit drop -> сама исчезнет после commit/rollback)
+STAGE_DDL: str = (
+    f"create temp table {STAGE_TABLE} ("
+    + ", ".join(f"{name} {pg_type}" for name, pg_type in COPY_COLUMNS)
+    + ") on commit drop;"
+)
+
+# 3C: бинарный COPY во временную таблицу
+COPY_SQL: str = f"copy {STAGE_TABLE} ({', '.join(COPY_NAMES)}) from stdin with (format binary)"
+
+# 3C: перенос из временной таблицы в основную с прежней логикой upsert.
+#     source_file один на весь файл — не копируем его в каждую строку,
+#     а передаём одним параметром %s прямо в select
+UPSERT_SQL: str = f"""
+insert into {TABLE_NAME} (source_file, {', '.join(COPY_NAMES)})
+select %s, {', '.join(COPY_NAMES)}
+from {STAGE_TABLE}
+on conflict (period, item_code)
+do update set
+    loaded_ts = now(),
+    source_file = excluded.source_file,
+
+    item = excluded.item,
+    article = excluded.article,
+
+    segment = excluded.segment,
+    pg = excluded.pg,
+    guz = excluded.guz,
+    gau = excluded.gau,
+    manager = excluded.manager,
+    supplier = excluded.supplier,
+
+    nonliq = excluded.nonliq,
+    n_descn = excluded.n_descn,
+    level_turns = excluded.level_turns,
+    rank_turns = excluded.rank_turns,
+
+    av_stock_qty = excluded.av_stock_qty,
+    sales_qty = excluded.sales_qty,
+    revenue = excluded.revenue,
+    curr_stock_qty = excluded.curr_stock_qty,
+
+    curr_stock_cost = excluded.curr_stock_cost,
+    sales_cost = excluded.sales_cost,
+    av_stock_cost = excluded.av_stock_cost,
+
+    turns_rub = excluded.turns_rub,
+
+    free_stock_q_ty = excluded.free_stock_q_ty,
+    free_stock_cost = excluded.free_stock_cost,
+
+    rezerv_qty = excluded.rezerv_qty,
+    rezerv_cost = excluded.rezerv_cost,
+
+    margin = excluded.margin,
+    prof_pc = excluded.prof_pc,
+    prof_stock = excluded.prof_stock,
+
+    payload = excluded.payload
+;
+"""
+
+
+def rename_to_db(df: pd.DataFrame) -> pd.DataFrame:
+    # 3C: новый DataFrame с колонками по контракту (исходный df не меняем)
+
+    # 3C: 1) чистим заголовки Excel от хвостовых/невидимых пробелов
+    # 3C: 2) и сразу переименовываем по контракту (русские -> DB-имена)
+    names = [normalize_excel_header(col) for col in df.columns]
+
+    # 3C: set_axis сам возвращает новый объект — отдельный df.copy() + rename не нужны
+    return df.set_axis([RUS_TO_DB.get(name, name) for name in names], axis=1)
 
 
-def upsert_dataframe(df: pd.DataFrame, source_file: str) -> Tuple[int, int]:
-    # 3C: основной загрузчик DataFrame -> Postgres (колонки + payload jsonb)
+def build_copy_rows(df: pd.DataFrame) -> List[Tuple[Any, ...]]:
+    # 3C: DataFrame с DB-именами колонок -> кортежи в порядке COPY_COLUMNS.
+    #     period/item_code здесь уже разобраны, отфильтрованы и без дублей (см. upsert_dataframe)
+
+    # 3C: разбираем каждую колонку один раз целиком, в порядке COPY_COLUMNS
+    columns: List[List[Any]] = []
+    for name, pg_type in COPY_COLUMNS:
+        if name == "payload":
+            # 3C: в payload только колонки вне контракта — контрактные уже лежат
+            #     в своих колонках таблицы, дублировать их в jsonb незачем
+            extras = [col for col in df.columns if col not in REQUIRED_DB_COLS]
+            if extras:
+                columns.append([Jsonb(payload) for payload in frame_to_payloads(df[extras])])
+            else:
+                columns.append([None] * len(df))
+        elif name in ("period", "item_code"):
+            columns.append(df[name].tolist())
+        else:
+            columns.append(COLUMN_PARSERS[pg_type](df[name]).tolist())
+
+    return list(zip(*columns))
+
+
+def upsert_dataframe(
+    df: pd.DataFrame,
+    source_file: str,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[int, int]:
+    # 3C: основной загрузчик DataFrame -> Postgres (колонки контракта + лишние колонки в payload jsonb)
+    #     progress(обработано_строк, всего_строк) вызывается после каждой пачки
     if df.empty:
         return (0, 0)
 
-    # 3C: 1) сначала чистим заголовки Excel от хвостовых/невидимых пробелов
-    df = df.copy()
-    df.columns = [normalize_excel_header(col) for col in df.columns]
-
-    # 3C: 2) переименовываем колонки отчёта по контракту (русские -> DB-имена)
-    df = df.rename(columns=RUS_TO_DB)
+    # 3C: 1) + 2) чистим заголовки и переименовываем по контракту
+    df = rename_to_db(df)
 
     # 3C: 3) проверяем, что контракт соблюдён (все обязательные колонки есть)
     missing = sorted(list(REQUIRED_DB_COLS - set(df.columns)))
@@ -501,288 +941,328 @@ def upsert_dataframe(df: pd.DataFrame, source_file: str) -> Tuple[int, int]:
             f"Actual columns after normalize/rename: {actual_cols}"
         )
 
-    rows: List[Tuple[Any, ...]] = []
-
-    for i in range(len(df)):
-        row = df.iloc[i]
-
-        # 3C: обязательные поля для уникальности снимка
-        period = parse_timestamp(row.get("period"))
-        item_code = _s(row.get("item_code"))
-
-        if period is None:
-            continue
-        if not item_code:
-            continue
-
-        payload = row_to_payload(row)
-
-        rows.append(
-            (
-                period,
-                source_file,
-
-                _s(row.get("item")),
-                item_code,
-                _s(row.get("article")),
-
-                _s(row.get("segment")),
-                _s(row.get("pg")),
-                _s(row.get("guz")),
-                _s(row.get("gau")),
-                _s(row.get("manager")),
-                _s(row.get("supplier")),
-
-                parse_bool(row.get("nonliq")),
-                _s(row.get("n_descn")),
-                _s(row.get("level_turns")),
-                _s(row.get("rank_turns")),
-
-                parse_numeric(row.get("av_stock_qty")),
-                parse_numeric(row.get("sales_qty")),
-                parse_numeric(row.get("revenue")),
-                parse_numeric(row.get("curr_stock_qty")),
-
-                parse_numeric(row.get("curr_stock_cost")),
-                parse_numeric(row.get("sales_cost")),
-                parse_numeric(row.get("av_stock_cost")),
-
-                parse_numeric(row.get("turns_rub")),
-
-                parse_numeric(row.get("free_stock_q_ty")),
-                parse_numeric(row.get("free_stock_cost")),
-
-                parse_numeric(row.get("rezerv_qty")),
-                parse_numeric(row.get("rezerv_cost")),
-
-                parse_numeric(row.get("margin")),
-                parse_numeric(row.get("prof_pc")),
-                parse_numeric(row.get("prof_stock")),
-
-                Jsonb(payload),
-            )
-        )
-
-    sql = f"""
-    insert into {TABLE_NAME} (
-        period, source_file,
-
-        item, item_code, article,
+    total_rows = len(df)  # 3C: строк в файле (до фильтров)
 
-        segment, pg, guz, gau, manager, supplier,
+    # 3C: 4) ключ снимка разбираем сразу по всему файлу
+    period = timestamp_column(df["period"])
+    item_code = text_column(df["item_code"])
 
-        nonliq, n_descn, level_turns, rank_turns,
+    # 3C: 5) отбрасываем строки без period или без кода товара (одной маской)
+    keep = period.notna() & item_code.notna() & (item_code != "")
+    df = df.loc[keep].assign(period=period.loc[keep], item_code=item_code.loc[keep])
 
-        av_stock_qty, sales_qty, revenue, curr_stock_qty,
+    # 3C: 6) дубли ключа (period, item_code) убираем до БД — побеждает последняя строка,
+    #     как и при построчном upsert; в Postgres уходит только то, что реально запишется
+    df = df.drop_duplicates(subset=["period", "item_code"], keep="last")
 
-        curr_stock_cost, sales_cost, av_stock_cost,
+    # 3C: 7) сортируем в порядке уникального индекса (period, item_code): вставки идут
+    #     по соседним страницам B-дерева, а не вразброс по всему индексу
+    df = df.sort_values(["period", "item_code"])
 
-        turns_rub,
+    attempt_rows = len(df)  # 3C: строк отправляем в БД (после фильтров и дублей)
+    if attempt_rows == 0:
+        return (total_rows, 0)
 
-        free_stock_q_ty, free_stock_cost,
-
-        rezerv_qty, rezerv_cost,
-
-        margin, prof_pc, prof_stock,
-
-        payload
-    )
-    values (
-        %s, %s,
-
-        %s, %s, %s,
-
-        %s, %s, %s, %s, %s, %s,
-
-        %s, %s, %s, %s,
-
-        %s, %s, %s, %s,
-
-        %s, %s, %s,
+    with db_connect() as conn:
+        with conn.cursor() as cur:
+            # 3C: временная таблица живёт только внутри этой транзакции
+            cur.execute(STAGE_DDL)
 
-        %s,
+            # 3C: 8) идём пачками: память не растёт с размером файла, всё в одной транзакции
+            for start in range(0, attempt_rows, UPSERT_CHUNK_ROWS):
+                rows = build_copy_rows(df.iloc[start:start + UPSERT_CHUNK_ROWS])
 
-        %s, %s,
+                # 3C: одна потоковая бинарная загрузка пачки вместо запроса на каждую строку
+                with cur.copy(COPY_SQL) as cp:
+                    cp.set_types(COPY_TYPES)
+                    for values in rows:
+                        cp.write_row(values)
 
-        %s, %s,
+                # 3C: один upsert пачки из временной таблицы в основную, затем чистим её
+                cur.execute(UPSERT_SQL, (source_file,))
+                cur.execute(f"truncate {STAGE_TABLE}")
 
-        %s, %s, %s,
+                if progress is not None:
+                    progress(min(start + UPSERT_CHUNK_ROWS, attempt_rows), attempt_rows)
+        conn.commit()
 
-        %s
-    )
-    on conflict (period, item_code)
-    do update set
-        loaded_ts = now(),
-        source_file = excluded.source_file,
+    return (total_rows, attempt_rows)
+# ===== 3C END =====
 
-        item = excluded.item,
-        article = excluded.article,
 
-        segment = excluded.segment,
-        pg = excluded.pg,
-        guz = excluded.guz,
-        gau = excluded.gau,
-        manager = excluded.manager,
-        supplier = excluded.supplier,
+# ===== 4A START =====
+# 4A: роутеры создаются один раз при импорте модуля — обработчики ниже (4B–6A)
+#     вешаются на них декораторами прямо на уровне модуля
+router = Router(name="turnover_bot")
+# 4A: отдельный роутер для catch-all отладки (6A), подключается только при BOT_DEBUG=1
+debug_router = Router(name="turnover_bot_debug")
 
-        nonliq = excluded.nonliq,
-        n_descn = excluded.n_descn,
-        level_turns = excluded.level_turns,
-        rank_turns = excluded.rank_turns,
 
-        av_stock_qty = excluded.av_stock_qty,
-        sales_qty = excluded.sales_qty,
-        revenue = excluded.revenue,
-        curr_stock_qty = excluded.curr_stock_qty,
+def build_app() -> Dispatcher:
+    # 4A: создаём диспетчер и подключаем к нему готовые роутеры
+    dp = Dispatcher()
+    dp.include_router(router)
+
+    # 4A: catch-all для отладки только по флагу — в проде он отвечал бы на каждое сообщение
+    if BOT_DEBUG:
+        dp.include_router(debug_router)
+    return dp
+# ===== 4A END =====
 
-        curr_stock_cost = excluded.curr_stock_cost,
-        sales_cost = excluded.sales_cost,
-        av_stock_cost = excluded.av_stock_cost,
 
-        turns_rub = excluded.turns_rub,
+# ===== 4B START =====
+# 4B: /start
+@router.message(CommandStart())
+async def start(message: Message) -> None:
+    await message.answer("Бот запущен. Жду Excel 📊")
+# ===== 4B END =====
 
-        free_stock_q_ty = excluded.free_stock_q_ty,
-        free_stock_cost = excluded.free_stock_cost,
 
-        rezerv_qty = excluded.rezerv_qty,
-        rezerv_cost = excluded.rezerv_cost,
+# ===== 4C START =====
+# 4C: /db
+@router.message(Command("db"))
+async def db_check(message: Message) -> None:
+    try:
+        # 4C: синхронную работу с БД уводим в поток, чтобы не блокировать event loop
+        await asyncio.to_thread(ensure_schema)
+        row = await asyncio.to_thread(db_fetchone, f"select to_regclass('{TABLE_NAME}');")
+        await message.answer(f"✅ БД доступна. Таблица: {row[0]}")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка БД: {type(e).__name__}: {e}")
+# ===== 4C END =====
 
-        margin = excluded.margin,
-        prof_pc = excluded.prof_pc,
-        prof_stock = excluded.prof_stock,
 
-        payload = excluded.payload
-    ;
-    """
+# ===== 4D START =====
+# 4D: /reprocess <файл.xlsx> — повторная загрузка из Parquet-копии, без Excel
+@router.message(Command("reprocess"))
+async def reprocess(message: Message, command: CommandObject) -> None:
+    if not command.args:
+        await message.answer("Укажи файл: /reprocess <имя файла.xlsx>")
+        return
 
-    with db_connect() as conn:
-        with conn.cursor() as cur:
-            cur.executemany(sql, rows)
-        conn.commit()
+    filename = Path(command.args.strip()).name
+    if not report_cache_path(filename).exists():
+        await message.answer(f"Нет сохранённой копии для файла: {filename}")
+        return
 
-    return (len(df), len(rows))
-# ===== 3C END =====
+    try:
+        df = await asyncio.to_thread(load_report_cache, filename)
+        # 4D: после первой успешной проверки это no-op; если при старте БД была недоступна —
+        #     схема создастся здесь
+        await asyncio.to_thread(ensure_schema)
+        total_rows, attempt_rows = await asyncio.to_thread(upsert_dataframe, df, filename)
+        await message.answer(
+            "✅ Повторная загрузка завершена.\n"
+            f"Строк в копии: {total_rows}\n"
+            f"Строк к вставке (после фильтров): {attempt_rows}"
+        )
+    except Exception as e:
+        await message.answer(f"❌ Ошибка повторной загрузки: {type(e).__name__}: {e}")
+# ===== 4D END =====
 
 
-# ===== 4A START =====
-def build_app() -> Dispatcher:
-    # 4A: создаём диспетчер
-    return Dispatcher()
-# ===== 4A END =====
+# ===== 5A START =====
+# 5A: file_unique_id уже загруженных файлов -> текст итогового ответа (самые свежие в конце)
+seen_uploads: "OrderedDict[str, str]" = OrderedDict()
+
+
+# 5A: обработчик документов
+@router.message(F.document)
+async def handle_document(message: Message) -> None:
+    # 5A: имя, MIME-тип и размер проверяем по метаданным — до скачивания файла
+    filename = message.document.file_name
+    mime_type = message.document.mime_type
+    if (
+        not filename
+        or not filename.lower().endswith(".xlsx")
+        or (mime_type is not None and mime_type not in XLSX_MIME_TYPES)
+    ):
+        await message.answer("Пришли, пожалуйста, файл .xlsx")
+        return
+
+    if (message.document.file_size or 0) > MAX_UPLOAD_BYTES:
+        await message.answer(f"Файл слишком большой: нужен .xlsx до {MAX_UPLOAD_BYTES // (1024 * 1024)} МБ")
+        return
+
+    # 5A: тот же файл уже загружали (повторная доставка или повторная отправка) —
+    #     не читаем и не грузим его ещё раз, а отвечаем прошлым итогом
+    unique_id = message.document.file_unique_id
+    summary = seen_uploads.get(unique_id)
+    if summary is not None:
+        seen_uploads.move_to_end(unique_id)
+        await message.answer(
+            f"♻️ Этот файл уже загружен.\n{summary}\n"
+            f"Загрузить заново: /reprocess {filename}"
+        )
+        return
 
+    # 5A: скачиваем файл сразу в память (без временного файла на диске);
+    #     bot.download сам получает file_path и после записи перематывает buf в начало
+    buf = io.BytesIO()
+    await message.bot.download(message.document, destination=buf)
 
-# ===== 4B START =====
-def register_start(dp: Dispatcher) -> None:
-    # 4B: /start
-    @dp.message(F.text == "/start")
-    async def start(message: Message) -> None:
-        await message.answer("Бот запущен. Жду Excel 📊")
-# ===== 4B END =====
+    # ===== 5B START =====
+    try:
+        # 5B: чтение Excel — тяжёлая работа для CPU, выполняем в отдельном процессе (2D)
+        df = await read_report_excel_in_pool(buf.getvalue())
+    except BrokenProcessPool:
+        await message.answer(
+            "❌ Процесс чтения Excel аварийно завершился (скорее всего, не хватило памяти).\n"
+            "Попробуй прислать файл ещё раз."
+        )
+        return
+    except Exception as e:
+        await message.answer(f"❌ Не смог прочитать Excel: {type(e).__name__}: {e}")
+        return
 
+    if df.empty:
+        await message.answer("Файл прочитан, но в нём 0 строк.")
+        return
 
-# ===== 4C START =====
-def register_db_check(dp: Dispatcher) -> None:
-    # 4C: /db
-    @dp.message(F.text == "/db")
-    async def db_check(message: Message) -> None:
-        try:
-            ensure_schema()
-            row = db_fetchone(f"select to_regclass('{TABLE_NAME}');")
-            await message.answer(f"✅ БД доступна. Таблица: {row[0]}")
-        except Exception as e:
-            await message.answer(f"❌ Ошибка БД: {type(e).__name__}: {e}")
-# ===== 4C END =====
+    cols = list(df.columns)
 
+    # 5B: все колонки контракта проверяем за один проход (заголовки — после нормализации)
+    #     и называем сразу все недостающие, а не падаем на первой в 3C
+    present = {normalize_excel_header(col) for col in cols}
+    missing = [rus for rus in RUS_TO_DB if rus not in present]
+    if missing:
+        await message.answer(
+            "Файл прочитан, но в нём нет колонок:\n"
+            + "\n".join(f"• {rus}" for rus in missing)
+        )
+        return
 
-# ===== 5A START =====
-def register_excel_upload(dp: Dispatcher) -> None:
-    # 5A: обработчик документов
-    @dp.message(F.document)
-    async def handle_document(message: Message) -> None:
-        filename = message.document.file_name
-        if not filename or not filename.lower().endswith(".xlsx"):
-            await message.answer("Пришли, пожалуйста, файл .xlsx")
-            return
-
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            tmp_path = Path(tmp_dir) / filename
-
-            tg_file = await message.bot.get_file(message.document.file_id)
-            await message.bot.download_file(tg_file.file_path, destination=tmp_path)
-
-            # ===== 5B START =====
-            try:
-                df = pd.read_excel(tmp_path)
-            except Exception as e:
-                await message.answer(f"❌ Не смог прочитать Excel: {type(e).__name__}: {e}")
-                return
+    # 5B: сохраняем Parquet-копию для /reprocess (ошибка кэша не мешает загрузке)
+    cached = False  # 5B: удалось ли сохранить копию (без неё повтор файла не отклоняем, см. 5C)
+    try:
+        await asyncio.to_thread(save_report_cache, df, filename)
+        cached = True
+    except Exception as e:
+        log.warning("Parquet cache for %s failed: %s: %s", filename, type(e).__name__, e)
+    # ===== 5B END =====
 
-            if df.empty:
-                await message.answer("Файл прочитан, но в нём 0 строк.")
+    # ===== 5C START =====
+    try:
+        # 5C: прогресс приходит из рабочего потока -> отправляем через event loop,
+        #     не чаще раза в PROGRESS_EVERY_S секунд
+        loop = asyncio.get_running_loop()
+        last_report = time.monotonic()
+
+        def report_progress(done: int, total: int) -> None:
+            nonlocal last_report
+            now = time.monotonic()
+            if done >= total or now - last_report < PROGRESS_EVERY_S:
                 return
+            last_report = now
+            asyncio.run_coroutine_threadsafe(
+                message.answer(f"⏳ Обработано строк: {done} из {total}"), loop
+            )
 
-            cols = list(df.columns)
+        # 5C: загрузка тоже в потоке — бот тем временем отвечает другим
+        #     ensure_schema после первой успешной проверки — no-op (см. 3B); если при старте
+        #     БД была недоступна, схема создастся здесь
+        await asyncio.to_thread(ensure_schema)
+        total_rows, attempt_rows = await asyncio.to_thread(
+            upsert_dataframe, df, filename, report_progress
+        )
+        summary = (
+            f"Строк в файле: {total_rows}\n"
+            f"Строк к вставке (после фильтров): {attempt_rows}\n"
+            f"Колонок в файле: {len(cols)}"
+        )
 
-            if "Period" not in cols and "Период" not in cols:
-                await message.answer(
-                    "Файл прочитан, но не вижу колонку 'Period' (или 'Период').\n"
-                    f"Первые колонки: {cols[:8]}"
-                )
-                return
-            # ===== 5B END =====
-
-            # ===== 5C START =====
-            try:
-                ensure_schema()
-                total_rows, attempt_rows = upsert_dataframe(df, source_file=filename)
-                await message.answer(
-                    "✅ Загрузка завершена.\n"
-                    f"Строк в файле: {total_rows}\n"
-                    f"Строк к вставке (после фильтров): {attempt_rows}\n"
-                    f"Колонок в файле: {len(cols)}"
-                )
-            except Exception as e:
-                await message.answer(f"❌ Ошибка загрузки в БД: {type(e).__name__}: {e}")
-                return
-            # ===== 5C END =====
+        # 5C: запоминаем файл только если есть Parquet-копия: иначе подсказка /reprocess
+        #     не сработала бы, а повторную отправку мы бы отклоняли.
+        #     Самый давно не встречавшийся файл вытесняем
+        if cached:
+            seen_uploads[unique_id] = summary
+            if len(seen_uploads) > SEEN_UPLOADS_MAX:
+                seen_uploads.popitem(last=False)
+
+        await message.answer(f"✅ Загрузка завершена.\n{summary}")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка загрузки в БД: {type(e).__name__}: {e}")
+        return
+    # ===== 5C END =====
 # ===== 5A END =====
 
 
 # ===== 6A START =====
-def register_fallback_debug(dp: Dispatcher) -> None:
-    # 6A: fallback для отладки
-    @dp.message()
-    async def debug_any(message: Message) -> None:
-        await message.answer(
-            "DEBUG:\n"
-            f"content_type={message.content_type}\n"
-            f"text={message.text is not None}\n"
-            f"document={message.document is not None}\n"
-            f"photo={message.photo is not None}\n"
-            f"caption={message.caption is not None}"
-        )
+# 6A: chat_id -> когда (time.monotonic) последний раз отвечали debug-сообщением
+_last_debug: Dict[int, float] = {}
+
+
+# 6A: fallback для отладки (роутер подключается только при BOT_DEBUG=1, см. 4A)
+@debug_router.message()
+async def debug_any(message: Message) -> None:
+    # 6A: каждое непойманное сообщение пишем в лог (это бесплатно, без запроса в Telegram)
+    log.debug(
+        "Unhandled message: chat=%s content_type=%s", message.chat.id, message.content_type
+    )
+
+    # 6A: отвечаем в чат не чаще раза в DEBUG_ECHO_EVERY_S — спам не превращается в спам ответов
+    now = time.monotonic()
+    if now - _last_debug.get(message.chat.id, float("-inf")) < DEBUG_ECHO_EVERY_S:
+        return
+    _last_debug[message.chat.id] = now
+
+    await message.answer(
+        "DEBUG:\n"
+        f"content_type={message.content_type}\n"
+        f"text={message.text is not None}\n"
+        f"document={message.document is not None}\n"
+        f"photo={message.photo is not None}\n"
+        f"caption={message.caption is not None}"
+    )
 # ===== 6A END =====
 
 
 # ===== 6B START =====
 async def main() -> None:
     # 6B: запуск приложения
-    logging.basicConfig(level=logging.INFO)
+    # 6B: корневой логгер — только WARNING, чтобы aiohttp/psycopg не писали строку
+    #     на каждый запрос; свои сообщения бота — INFO (DEBUG при BOT_DEBUG=1)
+    logging.basicConfig(level=logging.WARNING)
+    log.setLevel(logging.DEBUG if BOT_DEBUG else logging.INFO)
+    # 6B: "Start polling" от aiogram.dispatcher оставляем — по нему видно в логах Railway,
+    #     что бот поднялся; построчный "Update ... is handled" (aiogram.event) глушим
+    logging.getLogger("aiogram.dispatcher").setLevel(logging.INFO)
+    for noisy in ("aiogram.event", "aiohttp.access", "psycopg", "psycopg.pool"):
+        logging.getLogger(noisy).setLevel(logging.WARNING)
 
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is not set")
 
+    # 6B: пул соединений открываем при старте (ждём первое соединение)
+    #     и сразу проверяем схему БД.
+    #     Если БД сейчас недоступна — бот всё равно стартует, /db и загрузки повторят проверку.
+    try:
+        await asyncio.to_thread(lambda: db_pool().wait(timeout=30.0))
+        await asyncio.to_thread(ensure_schema)
+    except Exception as e:
+        log.error("ensure_schema at startup failed: %s: %s", type(e).__name__, e)
+        # 6B: по таймауту wait() сам закрывает пул — сбрасываем его,
+        #     чтобы следующий db_pool() создал новый, а не отдавал закрытый
+        await asyncio.to_thread(db_pool_close)
+
     bot = Bot(token=BOT_TOKEN)
     dp = build_app()
 
-    register_start(dp)
-    register_db_check(dp)
-    register_excel_upload(dp)
-    register_fallback_debug(dp)  # потом можно отключить блоком целиком
-
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # 6B: при остановке закрываем пул БД, процессы разбора Excel и HTTP-сессию бота
+        await asyncio.to_thread(db_pool_close)
+        excel_executor.shutdown(wait=False, cancel_futures=True)
+        await bot.session.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # 6B: uvloop (libuv, на C) — более быстрый event loop; под Windows его нет -> обычный asyncio
+    if importlib.util.find_spec("uvloop"):
+        import uvloop  # 6B: импорт здесь, т.к. пакет необязательный
+
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
 # ===== 6B END =====
\ No newline at end of file